@@ -1,17 +1,26 @@
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.collation import Collation
+from pymongo.errors import PyMongoError
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from datetime import datetime
 import httpx
-import random
+import numpy as np
 import os
+import tempfile
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import heapq
+import io
+import logging
 
-app = FastAPI(title="Country Currency & Exchange API")
+logger = logging.getLogger(__name__)
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "countries_db")
@@ -22,10 +31,40 @@ db = client[DB_NAME]
 countries_collection = db.countries
 metadata_collection = db.metadata
 
+# Shared HTTP client for the external APIs, opened in lifespan
+http_client: httpx.AsyncClient
+
+# Case-insensitive comparison used for name, region and currency lookups
+CASE_INSENSITIVE = Collation(locale="en", strength=2)
+
 CACHE_DIR = Path("cache")
 CACHE_DIR.mkdir(exist_ok=True)
 IMAGE_PATH = CACHE_DIR / "summary.png"
 
+# Summary PNG kept in memory as a (file version, bytes, ETag) tuple; the file
+# version is (mtime_ns, size) so images written by other workers are picked up
+_SUMMARY_IMAGE: Optional[Tuple[Tuple[int, int], bytes, str]] = None
+
+
+def _load_font(path: str, size: int, fallback):
+    """Load a TrueType font, falling back to the default bitmap font"""
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return fallback
+
+
+_DEFAULT_FONT = ImageFont.load_default()
+_TITLE_FONT = _load_font(
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 32, _DEFAULT_FONT
+)
+_HEADER_FONT = _load_font(
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 20, _DEFAULT_FONT
+)
+_TEXT_FONT = _load_font(
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 16, _DEFAULT_FONT
+)
+
 
 class Country(BaseModel):
     id: Optional[int] = None
@@ -40,6 +79,10 @@ class Country(BaseModel):
     last_refreshed_at: Optional[str] = None
 
 
+# Only fetch the fields exposed by the Country model
+COUNTRY_PROJECTION = {"_id": 0, **{field: 1 for field in Country.model_fields}}
+
+
 class StatusResponse(BaseModel):
     total_countries: int
     last_refreshed_at: Optional[str] = None
@@ -50,107 +93,201 @@ class ErrorResponse(BaseModel):
     details: Optional[dict] = None
 
 
-async def get_next_id():
-    """Get next auto-increment ID"""
+async def reserve_ids(count: int) -> int:
+    """Reserve `count` auto-increment IDs and return the first one"""
     counter = await db.counters.find_one_and_update(
-        {"_id": "country_id"}, {"$inc": {"seq": 1}}, upsert=True, return_document=True
+        {"_id": "country_id"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
     )
-    return counter["seq"] if counter else 1
+    return counter["seq"] - count + 1
 
 
 async def fetch_countries_data():
     """Fetch countries from external API"""
     url = "https://restcountries.com/v2/all?fields=name,capital,region,population,flag,currencies"
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
-            raise HTTPException(
-                status_code=503,
-                detail={
-                    "error": "External data source unavailable",
-                    "details": f"Could not fetch data from restcountries.com: {str(e)}",
-                },
-            )
+    try:
+        response = await http_client.get(url)
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "error": "External data source unavailable",
+                "details": f"Could not fetch data from restcountries.com: {str(e)}",
+            },
+        )
 
 
 async def fetch_exchange_rates():
     """Fetch exchange rates from external API"""
     url = "https://open.er-api.com/v6/latest/USD"
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("rates", {})
-        except httpx.HTTPError as e:
-            raise HTTPException(
-                status_code=503,
-                detail={
-                    "error": "External data source unavailable",
-                    "details": f"Could not fetch data from open.er-api.com: {str(e)}",
-                },
-            )
+    try:
+        response = await http_client.get(url)
+        response.raise_for_status()
+        data = response.json()
+        return data.get("rates", {})
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "error": "External data source unavailable",
+                "details": f"Could not fetch data from open.er-api.com: {str(e)}",
+            },
+        )
+
 
+# Fixed GDP multiplier (midpoint of the original 1000-2000 range) so refreshes
+# are deterministic
+GDP_MULTIPLIER = 1500.0
 
-def calculate_gdp(population: int, exchange_rate: Optional[float]) -> Optional[float]:
-    """Calculate estimated GDP"""
-    if exchange_rate is None or exchange_rate == 0:
-        return None
-    random_multiplier = random.uniform(1000, 2000)
-    return (population * random_multiplier) / exchange_rate
 
+def calculate_gdp(populations: np.ndarray, exchange_rates: np.ndarray) -> np.ndarray:
+    """Calculate estimated GDP for each country, 0 where the rate is unusable"""
+    valid = np.isfinite(exchange_rates) & (exchange_rates != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gdps = populations * GDP_MULTIPLIER / exchange_rates
+    return np.where(valid, gdps, 0.0)
 
-async def generate_summary_image(countries: List[dict], timestamp: str):
+
+def generate_summary_image(countries: List[dict], timestamp: str):
     """Generate summary image with top 5 countries by GDP"""
 
     img = Image.new("RGB", (800, 600), color="white")
     draw = ImageDraw.Draw(img)
 
-    try:
-        title_font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 32
-        )
-        header_font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 20
-        )
-        text_font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 16
-        )
-    except:
-        title_font = ImageFont.load_default()
-        header_font = ImageFont.load_default()
-        text_font = ImageFont.load_default()
-
-    draw.text((50, 30), "Country Data Summary", fill="#2C3E50", font=title_font)
+    draw.text((50, 30), "Country Data Summary", fill="#2C3E50", font=_TITLE_FONT)
 
     draw.text(
-        (50, 90), f"Total Countries: {len(countries)}", fill="#34495E", font=header_font
+        (50, 90),
+        f"Total Countries: {len(countries)}",
+        fill="#34495E",
+        font=_HEADER_FONT,
     )
 
-    draw.text((50, 120), f"Last Refreshed: {timestamp}", fill="#7F8C8D", font=text_font)
+    draw.text(
+        (50, 120), f"Last Refreshed: {timestamp}", fill="#7F8C8D", font=_TEXT_FONT
+    )
 
     draw.text(
-        (50, 170), "Top 5 Countries by Estimated GDP:", fill="#2C3E50", font=header_font
+        (50, 170),
+        "Top 5 Countries by Estimated GDP:",
+        fill="#2C3E50",
+        font=_HEADER_FONT,
     )
 
-    sorted_countries = sorted(
-        [c for c in countries if c.get("estimated_gdp")],
-        key=lambda x: x.get("estimated_gdp", 0),
-        reverse=True,
-    )[:5]
+    sorted_countries = heapq.nlargest(
+        5,
+        (c for c in countries if c.get("estimated_gdp")),
+        key=lambda c: c["estimated_gdp"],
+    )
 
     y_position = 210
     for i, country in enumerate(sorted_countries, 1):
         gdp = country.get("estimated_gdp", 0)
         gdp_str = f"${gdp:,.2f}" if gdp else "N/A"
         text = f"{i}. {country['name']}: {gdp_str}"
-        draw.text((70, y_position), text, fill="#34495E", font=text_font)
+        draw.text((70, y_position), text, fill="#34495E", font=_TEXT_FONT)
         y_position += 35
 
-    img.save(IMAGE_PATH)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=False, compress_level=1)
+    png = buf.getvalue()
+
+    # Write to a temp file and swap it in so concurrent refreshes never tear it
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".png.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        version = _file_version(os.stat(tmp_path))
+        os.replace(tmp_path, IMAGE_PATH)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    _cache_summary_png(version, png)
+
+
+def _file_version(stat: os.stat_result) -> Tuple[int, int]:
+    """Identify a written summary image by its mtime and size"""
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _cache_summary_png(version: Tuple[int, int], png: bytes):
+    """Keep the summary PNG and its ETag in memory for the image endpoint"""
+    global _SUMMARY_IMAGE
+    # Assigned as one tuple so readers never see a mismatched body and ETag
+    _SUMMARY_IMAGE = (version, png, f'"{hashlib.md5(png).hexdigest()}"')
+
+
+def _reload_summary_png(version: Tuple[int, int]):
+    """Read the summary PNG written by another process into the cache"""
+    _cache_summary_png(version, IMAGE_PATH.read_bytes())
+
+
+async def remove_duplicate_countries():
+    """Delete case-insensitive duplicate names, keeping the lowest id of each"""
+    pipeline = [
+        {"$sort": {"id": 1}},
+        {"$group": {"_id": "$name", "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    duplicates = []
+    async for group in countries_collection.aggregate(
+        pipeline, collation=CASE_INSENSITIVE
+    ):
+        duplicates.extend(group["ids"][1:])
+
+    if duplicates:
+        await countries_collection.delete_many({"_id": {"$in": duplicates}})
+        logger.warning("Removed %d duplicate countries", len(duplicates))
+
+
+async def create_indexes():
+    """Create indexes backing name lookups and the filter/sort paths"""
+    try:
+        # The unique name index cannot be built while duplicates exist
+        await remove_duplicate_countries()
+        await countries_collection.create_index(
+            [("name", 1)], unique=True, collation=CASE_INSENSITIVE
+        )
+        await countries_collection.create_index([("estimated_gdp", -1)])
+        await countries_collection.create_index([("population", -1)])
+        await countries_collection.create_index(
+            [("region", 1)], collation=CASE_INSENSITIVE, name="region_ci"
+        )
+        await countries_collection.create_index(
+            [("currency_code", 1)],
+            collation=CASE_INSENSITIVE,
+            name="currency_code_ci",
+        )
+    except PyMongoError:
+        # Start anyway; requests report database errors individually
+        logger.exception("Could not create countries indexes")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build indexes and hold the pooled HTTP client for the app's lifetime"""
+    global http_client
+    await create_indexes()
+    http_client = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=20),
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+app = FastAPI(
+    title="Country Currency & Exchange API",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 
 # API Endpoints
@@ -163,59 +300,71 @@ async def root():
 async def refresh_countries():
     """Fetch and cache all countries with exchange rates"""
     try:
-        countries_data = await fetch_countries_data()
-        exchange_rates = await fetch_exchange_rates()
+        countries_data, exchange_rates = await asyncio.gather(
+            fetch_countries_data(), fetch_exchange_rates()
+        )
 
         timestamp = datetime.utcnow().isoformat() + "Z"
         processed_countries = []
 
-        for country_data in countries_data:
-            name = country_data.get("name")
-            if not name:
-                continue
-
-            currencies = country_data.get("currencies", [])
-            currency_code = None
-            exchange_rate = None
-            estimated_gdp = None
-
-            if currencies and len(currencies) > 0:
-                currency_code = currencies[0].get("code")
+        # One query for every stored name -> id, looked up in memory below
+        existing_ids = {
+            c["name"].casefold(): c["id"]
+            async for c in countries_collection.find(
+                {}, {"name": 1, "id": 1, "_id": 0}
+            )
+        }
 
-                if currency_code and currency_code in exchange_rates:
-                    exchange_rate = exchange_rates[currency_code]
-                    population = country_data.get("population", 0)
-                    if population and exchange_rate:
-                        estimated_gdp = calculate_gdp(population, exchange_rate)
+        # Pre-index the fields GDP depends on so it is computed in one NumPy pass
+        countries_data = [c for c in countries_data if c.get("name")]
+        populations = [c.get("population") or 0 for c in countries_data]
+        currency_codes = [
+            c["currencies"][0].get("code") if c.get("currencies") else None
+            for c in countries_data
+        ]
+        rates = [exchange_rates.get(code) for code in currency_codes]
+        gdps = calculate_gdp(
+            np.array(populations, dtype=np.float64),
+            np.array([np.nan if r is None else r for r in rates], dtype=np.float64),
+        )
 
-            existing = await countries_collection.find_one(
-                {"name": {"$regex": f"^{name}$", "$options": "i"}}
-            )
+        # Reserve a contiguous block of IDs for new countries in one counter update
+        num_new = sum(c["name"].casefold() not in existing_ids for c in countries_data)
+        next_id = await reserve_ids(num_new) if num_new else 1
 
+        ops = []
+        for country_data, population, currency_code, exchange_rate, gdp in zip(
+            countries_data, populations, currency_codes, rates, gdps.tolist()
+        ):
+            name = country_data["name"]
             country_doc = {
                 "name": name,
                 "capital": country_data.get("capital"),
                 "region": country_data.get("region"),
-                "population": country_data.get("population", 0),
+                "population": population,
                 "currency_code": currency_code,
                 "exchange_rate": exchange_rate,
-                "estimated_gdp": estimated_gdp if estimated_gdp else 0,
+                "estimated_gdp": gdp,
                 "flag_url": country_data.get("flag"),
                 "last_refreshed_at": timestamp,
             }
 
-            if existing:
-        
-                await countries_collection.update_one(
-                    {"_id": existing["_id"]}, {"$set": country_doc}
+            country_id = existing_ids.get(name.casefold())
+            if country_id is None:
+                country_id = next_id
+                next_id += 1
+            ops.append(
+                UpdateOne(
+                    {"name": name},
+                    {"$set": country_doc, "$setOnInsert": {"id": country_id}},
+                    upsert=True,
+                    collation=CASE_INSENSITIVE,
                 )
-                country_doc["id"] = existing["id"]
-            else:
-                country_id = await get_next_id()
-                country_doc["id"] = country_id
-                await countries_collection.insert_one(country_doc)
+            )
+            processed_countries.append({**country_doc, "id": country_id})
 
-            processed_countries.append(country_doc)
+        if ops:
+            await countries_collection.bulk_write(ops, ordered=False)
 
         await metadata_collection.update_one(
             {"_id": "last_refresh"},
@@ -228,7 +377,11 @@ async def refresh_countries():
             upsert=True,
         )
 
-        await generate_summary_image(processed_countries, timestamp)
+        # PIL drawing and PNG encoding are blocking, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, generate_summary_image, processed_countries, timestamp
+        )
 
         return {
             "message": "Countries data refreshed successfully",
@@ -255,11 +408,15 @@ async def get_countries(
     query = {}
 
     if region:
-        query["region"] = {"$regex": f"^{region}$", "$options": "i"}
+        query["region"] = region
     if currency:
         query["currency_code"] = currency
 
-    cursor = countries_collection.find(query, {"_id": 0})
+    # Filters match case-insensitively through the region/currency indexes; an
+    # unfiltered query keeps the simple collation so sorts can use their indexes
+    cursor = countries_collection.find(
+        query, COUNTRY_PROJECTION, collation=CASE_INSENSITIVE if query else None
+    )
 
     if sort:
         if sort == "gdp_desc":
@@ -275,11 +432,35 @@ async def get_countries(
     return countries
 
 
+# Must be registered before /countries/{name} so "image" is not taken as a name
+@app.get("/countries/image")
+async def get_summary_image(request: Request):
+    """Serve the generated summary image"""
+    try:
+        version = _file_version(IMAGE_PATH.stat())
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=404, detail={"error": "Summary image not found"}
+        )
+
+    # Reload when the file was rewritten by another worker or a previous process
+    if _SUMMARY_IMAGE is None or _SUMMARY_IMAGE[0] != version:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _reload_summary_png, version)
+
+    _, png, etag = _SUMMARY_IMAGE
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=png, media_type="image/png", headers=headers)
+
+
 @app.get("/countries/{name}", response_model=Country)
 async def get_country(name: str):
     """Get a single country by name"""
     country = await countries_collection.find_one(
-        {"name": {"$regex": f"^{name}$", "$options": "i"}}, {"_id": 0}
+        {"name": name}, COUNTRY_PROJECTION, collation=CASE_INSENSITIVE
     )
 
     if not country:
@@ -292,38 +473,36 @@ async def get_country(name: str):
 async def delete_country(name: str):
     """Delete a country by name"""
     result = await countries_collection.delete_one(
-        {"name": {"$regex": f"^{name}$", "$options": "i"}}
+        {"name": name}, collation=CASE_INSENSITIVE
     )
 
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail={"error": "Country not found"})
 
+    # Keep the count served by /status in sync
+    await metadata_collection.update_one(
+        {"_id": "last_refresh"}, {"$inc": {"total_countries": -1}}
+    )
+
     return {"message": f"Country '{name}' deleted successfully"}
 
 
 @app.get("/status", response_model=StatusResponse)
 async def get_status():
     """Get total countries and last refresh timestamp"""
-    total = await countries_collection.count_documents({})
     metadata = await metadata_collection.find_one({"_id": "last_refresh"})
 
+    if metadata and "total_countries" in metadata:
+        total = metadata["total_countries"]
+    else:
+        total = await countries_collection.count_documents({})
+
     return {
         "total_countries": total,
         "last_refreshed_at": metadata.get("timestamp") if metadata else None,
     }
 
 
-@app.get("/countries/image")
-async def get_summary_image():
-    """Serve the generated summary image"""
-    if not IMAGE_PATH.exists():
-        raise HTTPException(
-            status_code=404, detail={"error": "Summary image not found"}
-        )
-
-    return FileResponse(IMAGE_PATH, media_type="image/png")
-
-
 if __name__ == "__main__":
     import uvicorn
 